@@ -6,6 +6,7 @@ Import and use these functions in your API endpoints for database operations.
 """
 
 from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -18,12 +19,18 @@ load_dotenv()
 _client = None
 db = None
 
+# Async (Motor) handle for the API routes; the helpers below stay synchronous
+_async_client = None
+async_db = None
+
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
     _client = MongoClient(database_url)
     db = _client[database_name]
+    _async_client = AsyncIOMotorClient(database_url)
+    async_db = _async_client[database_name]
 
 # Helper functions for common database operations
 def create_document(collection_name: str, data: Union[BaseModel, dict]):
@@ -1,11 +1,30 @@
+import asyncio
+import hashlib
+import logging
 import os
-from fastapi import FastAPI, HTTPException, Query
+import re
+import msgspec
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from typing import List, Optional, Sequence, Tuple
 from bson import ObjectId
+from pymongo.collation import Collation
+from pymongo.errors import ConnectionFailure, OperationFailure
 
-app = FastAPI(title="CTRL-Z API", version="0.1.0")
+# Resolve the database handle once at import; routes only do a None check.
+_DB_IMPORT_ERROR: Optional[Exception] = None
+try:
+    from database import async_db as _DB
+except Exception as e:
+    _DB = None
+    _DB_IMPORT_ERROR = e
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="CTRL-Z API", version="0.1.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,34 +35,106 @@ app.add_middleware(
 )
 
 # ---------- Schemas ----------
+_DEFAULT_SIZES: Tuple[str, ...] = ("XS","S","M","L","XL","XXL")
+
 class SizeOption(BaseModel):
     label: str
     available: bool = True
 
-class ProductModel(BaseModel):
+class ProductOut(msgspec.Struct):
+    """Product as returned by the API; built from trusted DB documents."""
+    id: str
     name: str
     description: str
     price: float
     category: str
     subcategory: Optional[str] = None
-    sizes: List[str] = Field(default_factory=lambda: ["XS","S","M","L","XL","XXL"]) 
-    images: List[str] = Field(default_factory=list)
+    sizes: Sequence[str] = _DEFAULT_SIZES
+    images: List[str] = []
     stock: int = 0
-    tags: List[str] = Field(default_factory=list)
-
-class ProductOut(ProductModel):
-    id: str
+    tags: List[str] = []
 
 class LoginRequest(BaseModel):
     email: str
     password: str
 
-class LoginResponse(BaseModel):
+class LoginResponse(msgspec.Struct):
     token: str
     user: dict
 
 # ---------- Helpers ----------
 
+# Case-insensitive (strength 2) collation shared by the category index and
+# category queries; a query only uses the index when the collations match.
+CATEGORY_COLLATION = Collation(locale="en", strength=2)
+
+SEARCH_FIELDS = ("name", "description", "tags")
+
+# Server error code for a $text query with no text index (IndexNotFound).
+INDEX_NOT_FOUND = 27
+
+# Only the fields ProductOut needs (_id is included by default).
+PRODUCT_PROJECTION = {
+    field: 1
+    for field in (
+        "name", "description", "price", "category", "subcategory",
+        "sizes", "images", "stock", "tags",
+    )
+}
+
+# Response bodies are encoded straight from msgspec structs to JSON bytes.
+encode_json = msgspec.json.Encoder().encode
+
+DEMO_TOKEN = "demo-token-ctrl-z"
+
+
+def openapi_schema(tp) -> dict:
+    """JSON schema for a msgspec type, with struct definitions inlined for OpenAPI."""
+    (schema,), defs = msgspec.json.schema_components([tp], ref_template="{name}")
+
+    def inline(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return inline(defs[node["$ref"]])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(value) for value in node]
+        return node
+
+    return inline(schema)
+
+
+def openapi_json(tp) -> dict:
+    """`responses=`/`requestBody` content entry documenting a msgspec type."""
+    return {"content": {"application/json": {"schema": openapi_schema(tp)}}}
+
+
+# Catalog reads are cached in-process as encoded JSON bodies (with their
+# ETag), keyed on the query and paging parameters, so repeat requests within
+# the TTL skip MongoDB entirely.
+PRODUCTS_CACHE_TTL = 60
+PRODUCTS_CACHE_HEADERS = {"Cache-Control": f"public, max-age={PRODUCTS_CACHE_TTL}"}
+_products_cache: TTLCache = TTLCache(maxsize=256, ttl=PRODUCTS_CACHE_TTL)
+
+# Hard cap on the server-side limit of any product query.
+PRODUCTS_MAX_LIMIT = 100
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def json_response(request: Request, body: bytes, etag: str, headers: Optional[dict] = None) -> Response:
+    """Return the encoded body, or an empty 304 if the client already has it."""
+    headers = {**(headers or {}), "ETag": etag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 def serialize_product(doc) -> ProductOut:
     return ProductOut(
         id=str(doc.get("_id")),
@@ -59,21 +150,74 @@ def serialize_product(doc) -> ProductOut:
     )
 
 
+# Static product served when the database is unavailable. It is constant, so
+# the encoded bodies and ETags are built once with a stable synthetic id.
+FALLBACK_PRODUCT = ProductOut(
+    id="000000000000000000000000",
+    name="CTRL-Z Oversized Tee — Neon Grid",
+    description="Heavyweight cotton tee with neon cyan glitch print.",
+    price=49.0,
+    category="Unisex",
+    subcategory="Tees",
+    sizes=_DEFAULT_SIZES,
+    images=[
+        "https://images.unsplash.com/photo-1520975661595-6453be3f7070?q=80&w=1200&auto=format&fit=crop",
+        "https://images.unsplash.com/photo-1548883354-94bcfe321cce?q=80&w=1200&auto=format&fit=crop",
+        "https://images.unsplash.com/photo-1520974735194-6c0a6b4a37d1?q=80&w=1200&auto=format&fit=crop"
+    ],
+    stock=120,
+    tags=["glitch","oversized","core"],
+)
+FALLBACK_PRODUCT_BODY = encode_json(FALLBACK_PRODUCT)
+FALLBACK_PRODUCT_ETAG = make_etag(FALLBACK_PRODUCT_BODY)
+FALLBACK_PRODUCTS_BODY = encode_json([FALLBACK_PRODUCT])
+FALLBACK_PRODUCTS_ETAG = make_etag(FALLBACK_PRODUCTS_BODY)
+
+
+# schemas.py is static for the life of the process, so read and encode it once.
+try:
+    with open("schemas.py", "r") as f:
+        SCHEMAS_BODY = encode_json({"schemas": f.read()})
+except Exception as e:
+    SCHEMAS_BODY = encode_json({"error": str(e)})
+
+
 def database_available() -> bool:
-    try:
-        from database import db
-        return db is not None
-    except Exception:
-        return False
+    return _DB is not None
+
+
+PRODUCT_INDEXES = [
+    ([("category", 1)], {"collation": CATEGORY_COLLATION}),
+    ([("tags", 1)], {}),
+    (
+        [(field, "text") for field in SEARCH_FIELDS],
+        {"weights": {"name": 10, "tags": 5, "description": 1}},
+    ),
+]
 
 
-def ensure_seed_data():
+async def ensure_indexes():
+    """Create the product indexes the catalog queries rely on. Idempotent."""
+    if _DB is None:
+        return
+    products = _DB["product"]
+    # Each index is attempted on its own so one server-side failure (e.g. an
+    # options conflict with an existing index) does not skip the rest.
+    # Connection failures propagate so prepare_database() can retry.
+    for keys, options in PRODUCT_INDEXES:
+        try:
+            await products.create_index(keys, background=True, **options)
+        except OperationFailure:
+            logger.exception("Failed to create product index %s", keys)
+
+
+async def ensure_seed_data():
     """Seed a few products if collection empty. Safe no-op if db missing."""
     try:
-        from database import db
-        if db is None:
+        if _DB is None:
             return
-        if db["product"].count_documents({}) == 0:
+        # Collection metadata is enough for an emptiness probe.
+        if await _DB["product"].estimated_document_count() == 0:
             seed = [
                 {
                     "name": "CTRL-Z Oversized Tee — Neon Grid",
@@ -121,11 +265,137 @@ def ensure_seed_data():
                     "tags": ["cropped","hoodie"],
                 },
             ]
-            db["product"].insert_many(seed)
+            await _DB["product"].insert_many(seed)
+    except ConnectionFailure:
+        raise
     except Exception:
         pass
 
 
+async def find_products(category: Optional[str], q: Optional[str], limit: int, skip: int = 0) -> list:
+    """Fetch one page of products, using the text index when searching.
+
+    Results are sorted with _id as the final key so skip/limit pages are stable.
+    """
+    limit = min(limit, PRODUCTS_MAX_LIMIT)
+    products = _DB["product"]
+    if not q:
+        filter_obj = {"category": category} if category else {}
+        cursor = products.find(filter_obj, PRODUCT_PROJECTION, collation=CATEGORY_COLLATION)
+        cursor = cursor.sort("_id", 1).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    # $text queries only run under the simple collation, so the category
+    # match is expressed as an escaped, anchored case-insensitive regex here.
+    filter_obj = {"$text": {"$search": q}}
+    if category:
+        filter_obj["category"] = re.compile(f"^{re.escape(category)}$", re.I)
+    score = {"$meta": "textScore"}
+    try:
+        cursor = products.find(filter_obj, {**PRODUCT_PROJECTION, "score": score})
+        cursor = cursor.sort([("score", score), ("_id", 1)]).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+    except OperationFailure as e:
+        if e.code != INDEX_NOT_FOUND:
+            raise
+        # No text index available: fall back to prefix-anchored regexes.
+        prefix = re.compile(f"^{re.escape(q)}", re.I)
+        filter_obj = {"$or": [{field: prefix} for field in SEARCH_FIELDS]}
+        if category:
+            filter_obj["category"] = category
+        cursor = products.find(filter_obj, PRODUCT_PROJECTION, collation=CATEGORY_COLLATION)
+        cursor = cursor.sort("_id", 1).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+
+
+# Health state for /test: collections are listed once at startup and the
+# liveness ping is re-issued at most every HEALTH_PING_TTL seconds.
+HEALTH_PING_TTL = 5
+_HEALTH_STATE: dict = {"collections": [], "error": None}
+_DATABASE_URL_SET = bool(os.getenv("DATABASE_URL"))
+_DATABASE_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+_ping_cache: TTLCache = TTLCache(maxsize=1, ttl=HEALTH_PING_TTL)
+_ping_task: Optional[asyncio.Task] = None
+_MISSING = object()
+
+
+async def probe_collections():
+    try:
+        collections = await _DB.list_collection_names()
+        _HEALTH_STATE["collections"] = collections[:10]
+        _HEALTH_STATE["error"] = None
+    except Exception as e:
+        _HEALTH_STATE["error"] = str(e)[:50]
+
+
+async def _ping() -> Optional[str]:
+    try:
+        await _DB.command("ping")
+        result = None
+    except Exception as e:
+        result = str(e)[:50]
+    _ping_cache["ping"] = result
+    return result
+
+
+async def ping_database() -> Optional[str]:
+    """Return None if the database answers a (cached) ping, else the error.
+
+    Concurrent callers on a cache miss share one in-flight ping.
+    """
+    global _ping_task
+    result = _ping_cache.get("ping", _MISSING)
+    if result is not _MISSING:
+        return result
+    if _ping_task is None or _ping_task.done():
+        _ping_task = asyncio.ensure_future(_ping())
+    # Shielded so a disconnecting caller does not cancel the shared ping.
+    return await asyncio.shield(_ping_task)
+
+
+# Backoff between attempts to reach the database during background setup.
+DB_SETUP_INITIAL_DELAY = 1
+DB_SETUP_MAX_DELAY = 60
+_db_setup_task: Optional[asyncio.Task] = None
+
+
+async def prepare_database():
+    """Create indexes, seed and probe collections once the database answers.
+
+    Runs in the background so an unreachable database never delays startup;
+    connection failures are retried with exponential backoff.
+    """
+    delay = DB_SETUP_INITIAL_DELAY
+    while True:
+        try:
+            await _DB.command("ping")
+            await ensure_indexes()
+            await ensure_seed_data()
+            await probe_collections()
+            return
+        except ConnectionFailure as e:
+            logger.warning("Database setup deferred (%s); retrying in %ss", e, delay)
+        except Exception:
+            logger.exception("Database setup failed")
+            return
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, DB_SETUP_MAX_DELAY)
+
+
+# ---------- Lifecycle ----------
+@app.on_event("startup")
+async def prepare_database_on_startup():
+    global _db_setup_task
+    if _DB is not None:
+        _db_setup_task = asyncio.create_task(prepare_database())
+
+
+@app.on_event("shutdown")
+async def stop_database_setup():
+    if _db_setup_task is not None:
+        _db_setup_task.cancel()
+
+
 # ---------- Routes ----------
 @app.get("/", tags=["health"])
 def read_root():
@@ -133,7 +403,7 @@ def read_root():
 
 
 @app.get("/test", tags=["health"])
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -143,124 +413,92 @@ def test_database():
         "collections": []
     }
     try:
-        from database import db
-        if db is not None:
+        if isinstance(_DB_IMPORT_ERROR, ImportError):
+            response["database"] = "❌ Database module not found"
+        elif _DB_IMPORT_ERROR is not None:
+            response["database"] = f"❌ Error: {str(_DB_IMPORT_ERROR)[:50]}"
+        elif _DB is not None:
             response["database"] = "✅ Available"
-            response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = getattr(db, "name", None) or "✅ Connected"
+            response["database_name"] = getattr(_DB, "name", None) or "✅ Connected"
             response["connection_status"] = "Connected"
-            try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+            error = await ping_database()
+            if error is None and _HEALTH_STATE["error"] is not None:
+                # The startup probe failed but the database is back; retry it.
+                await probe_collections()
+            error = error or _HEALTH_STATE["error"]
+            if error is None:
+                response["collections"] = _HEALTH_STATE["collections"]
                 response["database"] = "✅ Connected & Working"
-            except Exception as e:
-                response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
+            else:
+                response["database"] = f"⚠️ Connected but Error: {error}"
         else:
             response["database"] = "⚠️ Available but not initialized"
-    except ImportError:
-        response["database"] = "❌ Database module not found"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if _DATABASE_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if _DATABASE_NAME_SET else "❌ Not Set"
     return response
 
 
-@app.get("/api/products", response_model=List[ProductOut], tags=["products"])
-def list_products(
+@app.get("/api/products", responses={200: openapi_json(List[ProductOut])}, tags=["products"])
+async def list_products(
+    request: Request,
     category: Optional[str] = Query(None),
-    q: Optional[str] = Query(None)
+    q: Optional[str] = Query(None),
+    limit: int = Query(24, ge=1, le=PRODUCTS_MAX_LIMIT),
+    skip: int = Query(0, ge=0),
 ):
-    """List products with optional category or search query"""
-    ensure_seed_data()
-
+    """List products with optional category or search query, one page at a time"""
     # If DB available, query it; else return static fallback
     if database_available():
-        from database import db
-        filter_obj = {}
-        if category:
-            filter_obj["category"] = {"$regex": f"^{category}$", "$options": "i"}
-        if q:
-            filter_obj["$or"] = [
-                {"name": {"$regex": q, "$options": "i"}},
-                {"description": {"$regex": q, "$options": "i"}},
-                {"tags": {"$regex": q, "$options": "i"}},
-            ]
-        docs = list(db["product"].find(filter_obj).limit(48))
-        return [serialize_product(d) for d in docs]
+        key = (category, q, limit, skip)
+        cached = _products_cache.get(key)
+        if cached is None:
+            # A page is at most PRODUCTS_MAX_LIMIT documents, so it is encoded
+            # in one pass; the body and its ETag are then served from the cache.
+            docs = await find_products(category, q, limit, skip)
+            body = encode_json([serialize_product(d) for d in docs])
+            cached = (body, make_etag(body))
+            _products_cache[key] = cached
+        body, etag = cached
+        return json_response(request, body, etag, PRODUCTS_CACHE_HEADERS)
     else:
-        fallback = [
-            {
-                "_id": ObjectId(),
-                "name": "CTRL-Z Oversized Tee — Neon Grid",
-                "description": "Heavyweight cotton tee with neon cyan glitch print.",
-                "price": 49.0,
-                "category": "Unisex",
-                "subcategory": "Tees",
-                "sizes": ["XS","S","M","L","XL","XXL"],
-                "images": [
-                    "https://images.unsplash.com/photo-1520975661595-6453be3f7070?q=80&w=1200&auto=format&fit=crop",
-                    "https://images.unsplash.com/photo-1548883354-94bcfe321cce?q=80&w=1200&auto=format&fit=crop",
-                    "https://images.unsplash.com/photo-1520974735194-6c0a6b4a37d1?q=80&w=1200&auto=format&fit=crop"
-                ],
-                "stock": 120,
-                "tags": ["glitch","oversized","core"],
-            }
-        ]
-        return [serialize_product(d) for d in fallback]
-
-
-@app.get("/api/products/{product_id}", response_model=ProductOut, tags=["products"])
-def get_product(product_id: str):
+        return json_response(request, FALLBACK_PRODUCTS_BODY, FALLBACK_PRODUCTS_ETAG)
+
+
+@app.get("/api/products/{product_id}", responses={200: openapi_json(ProductOut)}, tags=["products"])
+async def get_product(request: Request, product_id: str):
     if database_available():
-        from database import db
         try:
-            doc = db["product"].find_one({"_id": ObjectId(product_id)})
+            doc = await _DB["product"].find_one({"_id": ObjectId(product_id)}, PRODUCT_PROJECTION)
             if not doc:
                 raise HTTPException(status_code=404, detail="Product not found")
-            return serialize_product(doc)
+            body = encode_json(serialize_product(doc))
+            return json_response(request, body, make_etag(body))
         except Exception:
             raise HTTPException(status_code=400, detail="Invalid product id")
     else:
-        # Fallback single product
-        return ProductOut(
-            id=str(ObjectId()),
-            name="CTRL-Z Oversized Tee — Neon Grid",
-            description="Heavyweight cotton tee with neon cyan glitch print.",
-            price=49.0,
-            category="Unisex",
-            subcategory="Tees",
-            sizes=["XS","S","M","L","XL","XXL"],
-            images=[
-                "https://images.unsplash.com/photo-1520975661595-6453be3f7070?q=80&w=1200&auto=format&fit=crop",
-                "https://images.unsplash.com/photo-1548883354-94bcfe321cce?q=80&w=1200&auto=format&fit=crop",
-                "https://images.unsplash.com/photo-1520974735194-6c0a6b4a37d1?q=80&w=1200&auto=format&fit=crop"
-            ],
-            stock=120,
-            tags=["glitch","oversized","core"],
-        )
-
-
-@app.post("/api/auth/login", response_model=LoginResponse, tags=["auth"])
-def login(payload: LoginRequest):
-    # Placeholder auth (demo): validate shape and return a fake token
-    if not payload.email or not payload.password:
+        return json_response(request, FALLBACK_PRODUCT_BODY, FALLBACK_PRODUCT_ETAG)
+
+
+@app.post("/api/auth/login", responses={200: openapi_json(LoginResponse)}, tags=["auth"])
+async def login(payload: LoginRequest):
+    # Placeholder auth (demo): validate shape and return a fake token.
+    # Real credential checks must compare hashes with hmac.compare_digest.
+    if not (payload.email and payload.password):
         raise HTTPException(status_code=400, detail="Email and password required")
-    return LoginResponse(
-        token="demo-token-ctrl-z",
+    body = encode_json(LoginResponse(
+        token=DEMO_TOKEN,
         user={"email": payload.email, "name": "Z-User"}
-    )
+    ))
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/schema", tags=["schemas"]) 
-def get_schemas():
+async def get_schemas():
     # Expose schemas.py content for viewer
-    try:
-        with open("schemas.py", "r") as f:
-            return {"schemas": f.read()}
-    except Exception as e:
-        return {"error": str(e)}
+    return Response(content=SCHEMAS_BODY, media_type="application/json")
 
 
 if __name__ == "__main__":